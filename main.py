@@ -1,20 +1,71 @@
+import asyncio
+import hashlib
+import json
 import os
-import uuid
-from datetime import datetime
+import secrets
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import Optional
 
-from fastapi import FastAPI, UploadFile, Form, Request
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
+# -----------------------------
+# Thread configuration
+# -----------------------------
+def _physical_cores() -> int:
+    # count unique (physical id, core id) pairs so SMT siblings don't get
+    # their own CT2 thread — oversubscription is slower, not faster
+    try:
+        seen = set()
+        phys = core = None
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("physical id"):
+                    phys = line.split(":", 1)[1].strip()
+                elif line.startswith("core id"):
+                    core = line.split(":", 1)[1].strip()
+                elif not line.strip() and phys is not None and core is not None:
+                    seen.add((phys, core))
+                    phys = core = None
+        if seen:
+            return len(seen)
+    except OSError:
+        pass
+    return os.cpu_count() or 1
+
+CPU_THREADS = int(os.getenv("WHISPER_CPU_THREADS", _physical_cores()))
+NUM_WORKERS = int(os.getenv("WHISPER_NUM_WORKERS", "1"))
+# CT2/OpenMP read this at import time, so pin it before faster_whisper loads
+os.environ.setdefault("OMP_NUM_THREADS", str(CPU_THREADS))
+
+import numpy as np
+from fastapi import FastAPI, UploadFile, Form, Request, WebSocket, WebSocketDisconnect
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import iterate_in_threadpool
 
-from faster_whisper import WhisperModel
+from faster_whisper import BatchedInferencePipeline, WhisperModel, decode_audio
 from docx import Document
 
 # -----------------------------
 # App setup
 # -----------------------------
 app = FastAPI(title="Nova Transcribe (Faster-Whisper)")
+
+class SelectiveGZipMiddleware(GZipMiddleware):
+    # gzip would buffer the per-segment NDJSON lines instead of flushing
+    # them to the client, and DOCX files are already-deflated ZIPs
+    _EXCLUDE = ("/api/transcribe/stream", "/download/")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith(self._EXCLUDE):
+            await self.app(scope, receive, send)
+        else:
+            await super().__call__(scope, receive, send)
+
+app.add_middleware(SelectiveGZipMiddleware, minimum_size=1024)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
@@ -22,15 +73,174 @@ templates = Jinja2Templates(directory="templates")
 # Model
 # -----------------------------
 DEFAULT_MODEL = os.getenv("WHISPER_MODEL", "tiny")
-# device="cpu" for free hosting; compute_type="int8" saves memory
-MODEL = WhisperModel(DEFAULT_MODEL, device="cpu", compute_type="int8")
+
+def _autodetect_compute_type() -> str:
+    # int8_float32 beats pure int8 on AVX-512 VNNI hosts; int8 wins elsewhere
+    try:
+        with open("/proc/cpuinfo") as f:
+            if "avx512_vnni" in f.read():
+                return "int8_float32"
+    except OSError:
+        pass
+    return "int8"
+
+def _autodetect_device() -> str:
+    # CT2 ships its own CUDA probe, so no torch dependency is needed
+    try:
+        import ctranslate2
+        if ctranslate2.get_cuda_device_count() > 0:
+            return "cuda"
+    except Exception:
+        pass
+    return "cpu"
+
+DEVICE = os.getenv("WHISPER_DEVICE") or _autodetect_device()
+# float16 on GPU; int8 variants keep memory low enough for free CPU hosting
+COMPUTE_TYPE = os.getenv("WHISPER_COMPUTE_TYPE") or ("float16" if DEVICE == "cuda" else _autodetect_compute_type())
+
+# greedy decoding is near-identical in quality for short uploads and far faster
+DEFAULT_BEAM_SIZE = int(os.getenv("DEFAULT_BEAM_SIZE", "1"))
+
+# inference is CPU-bound and synchronous: run it in a bounded pool so the
+# event loop (and /health) keeps responding while a transcription is running
+MAX_PARALLEL = int(os.getenv("WHISPER_PARALLEL", "1"))
+EXECUTOR = ThreadPoolExecutor(max_workers=MAX_PARALLEL)
+TRANSCRIBE_SEM = asyncio.Semaphore(MAX_PARALLEL)
+
+@lru_cache(maxsize=2)
+def get_model(model_size: str) -> WhisperModel:
+    if DEVICE == "cuda":
+        try:
+            return WhisperModel(model_size, device="cuda", compute_type=COMPUTE_TYPE)
+        except Exception:
+            pass  # broken/partial CUDA install — fall back to CPU below
+    compute = COMPUTE_TYPE if DEVICE == "cpu" else _autodetect_compute_type()
+    return WhisperModel(model_size, device="cpu", compute_type=compute,
+                        cpu_threads=CPU_THREADS, num_workers=NUM_WORKERS)
+
+# opt-in batched decoding: the pipeline VAD-chunks the audio and decodes
+# several chunks per forward pass, which is a big win on long files
+ENABLE_BATCHING = os.getenv("ENABLE_BATCHING", "0") == "1"
+BATCH_SIZE = int(os.getenv("WHISPER_BATCH_SIZE", "8"))
+
+@lru_cache(maxsize=2)
+def get_pipeline(model_size: str) -> BatchedInferencePipeline:
+    return BatchedInferencePipeline(model=get_model(model_size))
+
+def run_transcribe(model_size: str, audio, **kwargs):
+    if ENABLE_BATCHING:
+        return get_pipeline(model_size).transcribe(audio, batch_size=BATCH_SIZE, **kwargs)
+    return get_model(model_size).transcribe(audio, **kwargs)
+
+def decode_upload(fileobj):
+    # 16 kHz mono float32, decoded straight from the spooled upload —
+    # both transcribe paths accept the array directly
+    fileobj.seek(0)
+    return decode_audio(fileobj)
+
+def hash_upload(fileobj) -> str:
+    h = hashlib.blake2b(digest_size=32)
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(1 << 20), b""):
+        h.update(chunk)
+    return h.hexdigest()
+
+# bounded LRU of finished results so re-submitting the same file (a common
+# pattern while reviewing the DOCX) skips inference entirely
+RESULT_CACHE: OrderedDict = OrderedDict()
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "512"))
+
+# one lock per model size so two requests can't both load the same weights
+_model_locks: dict = defaultdict(asyncio.Lock)
+
+# preload the default so the first request doesn't pay the load cost
+get_model(DEFAULT_MODEL)
 
 OUTPUT_DIR = "outputs"
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+# delete generated files after this long so the directory stays bounded
+OUTPUT_MAX_AGE_SEC = int(os.getenv("OUTPUT_MAX_AGE_SEC", "3600"))
+_SWEEP_INTERVAL_SEC = 300
+
+async def _sweep_outputs():
+    while True:
+        def _sweep():
+            now = time.time()
+            # scandir: one syscall per entry vs. listdir + stat's two
+            with os.scandir(OUTPUT_DIR) as it:
+                for entry in it:
+                    try:
+                        if entry.is_file() and now - entry.stat().st_mtime > OUTPUT_MAX_AGE_SEC:
+                            os.unlink(entry.path)
+                    except OSError:
+                        pass  # already gone or being written; next pass
+
+        await asyncio.to_thread(_sweep)
+        await asyncio.sleep(_SWEEP_INTERVAL_SEC)
+
+# -----------------------------
+# DOCX output
+# -----------------------------
+# in-flight DOCX builds, keyed by file name; /download awaits these so the
+# JSON response never has to wait for XML serialization
+_docx_tasks: dict = {}
+def build_docx(docx_path, source_name, model_size, language, duration, text):
+    doc = Document()
+    doc.add_heading("Transcription", level=1)
+
+    fields = [
+        ("Source: ", source_name or "Uploaded file"),
+        ("\nModel: ", model_size),
+    ]
+    if language:
+        fields.append(("\nDetected language: ", str(language)))
+    if duration:
+        fields.append(("\nDuration: ", f"{duration:.1f}s"))
+
+    meta = doc.add_paragraph()
+    for label, value in fields:
+        meta.add_run(label).bold = True
+        meta.add_run(value)
+    doc.add_paragraph("")
+    if text:
+        doc.add_paragraph(text)
+
+    doc.save(docx_path)
+
+def start_docx_build(docx_name, docx_path, source_name, model_size, language, duration, text):
+    task = asyncio.create_task(
+        asyncio.to_thread(build_docx, docx_path, source_name, model_size, language, duration, text)
+    )
+    _docx_tasks[docx_name] = task
+
+    # drop the entry once the build settles so never-downloaded files don't
+    # leak tasks; a download racing the pop just serves the finished file
+    # (or hits the 404 path if the build failed)
+    def _done(t):
+        t.exception()
+        _docx_tasks.pop(docx_name, None)
+
+    task.add_done_callback(_done)
+    return task
+
 # -----------------------------
 # Routes
 # -----------------------------
+@app.on_event("startup")
+async def warm_model():
+    # run one second of silence through the default model so the first real
+    # request doesn't pay for CT2's lazy GEMM planning or the Silero VAD
+    # ONNX session load
+    silence = np.zeros(16000, dtype=np.float32)
+
+    def _warm():
+        segments, _ = run_transcribe(DEFAULT_MODEL, silence, beam_size=1, vad_filter=True)
+        list(segments)
+
+    await asyncio.get_running_loop().run_in_executor(EXECUTOR, _warm)
+    asyncio.create_task(_sweep_outputs())
+
 @app.get("/health")
 async def health():
     return {"ok": True, "model": DEFAULT_MODEL}
@@ -46,62 +256,76 @@ async def index(request: Request):
 async def transcribe_api(
     file: UploadFile,
     model_size: str = Form(DEFAULT_MODEL),
-    beam_size: int = Form(5),
-    word_timestamps: Optional[bool] = Form(False)
+    beam_size: int = Form(DEFAULT_BEAM_SIZE),
+    word_timestamps: Optional[bool] = Form(False),
+    vad_filter: bool = Form(True),
+    vad_min_silence_ms: int = Form(500)
 ):
-    global MODEL
-
     base_name = os.path.splitext(file.filename or "audio")[0]
-    ext = os.path.splitext(file.filename or "")[1].lower() or ".wav"
-    uid = uuid.uuid4().hex[:8]
-    input_path = os.path.join(OUTPUT_DIR, f"{base_name}_{uid}{ext}")
 
-    with open(input_path, "wb") as f:
-        f.write(await file.read())
+    # same bytes + same options = same result; hashing is far cheaper than
+    # decoding, so check before touching the audio
+    digest = await asyncio.to_thread(hash_upload, file.file)
+    cache_key = (digest, model_size or DEFAULT_MODEL, beam_size, bool(word_timestamps), vad_filter, vad_min_silence_ms)
+    cached = RESULT_CACHE.get(cache_key)
+    if cached is not None:
+        RESULT_CACHE.move_to_end(cache_key)
+        # the sweeper may have deleted the DOCX since this was cached —
+        # rebuild it from the cached fields so the link stays valid
+        docx_name = cached["docx_file"].rsplit("/", 1)[-1]
+        docx_path = f"{OUTPUT_DIR}/{docx_name}"
+        if docx_name not in _docx_tasks and not await asyncio.to_thread(os.path.exists, docx_path):
+            start_docx_build(docx_name, docx_path, cached["filename"], cached["model"],
+                             cached["language"], cached["duration_seconds"], cached["text"])
+        return cached
 
-    # reload model if user requested a different size
-    current_model = DEFAULT_MODEL
-    if model_size and model_size != current_model:
-        try:
-            MODEL = WhisperModel(model_size, device="cpu", compute_type="int8")
-            current_model = model_size
-        except Exception as e:
-            return JSONResponse(status_code=400, content={"error": f"Failed to load model '{model_size}': {e}"})
+    try:
+        audio = await asyncio.to_thread(decode_upload, file.file)
+    except Exception as e:
+        return JSONResponse(status_code=400, content={"error": f"Could not decode audio: {e}"})
 
+    # cached lookup: only the first request for a given size pays the load cost
+    model_size = model_size or DEFAULT_MODEL
     try:
-        segments, info = MODEL.transcribe(input_path, beam_size=beam_size, word_timestamps=bool(word_timestamps))
+        async with _model_locks[model_size]:
+            # a cache miss loads weights (seconds to minutes) — keep that
+            # off the event loop
+            await asyncio.to_thread(get_model, model_size)
     except Exception as e:
-        return JSONResponse(status_code=500, content={"error": f"Transcription failed: {e}"})
+        return JSONResponse(status_code=400, content={"error": f"Failed to load model '{model_size}': {e}"})
+
+    # transcribe() returns a lazy generator, so consume it inside the worker
+    # thread as well — otherwise decoding would still run on the event loop;
+    # accumulate the text in the same pass instead of keeping segment objects
+    def _run_transcribe():
+        # vad_filter skips silence before decoding — big win on audio with
+        # long pauses, and avoids hallucinated repeats on silent stretches
+        segments, info = run_transcribe(
+            model_size, audio,
+            beam_size=beam_size,
+            word_timestamps=bool(word_timestamps),
+            vad_filter=vad_filter,
+            vad_parameters=dict(min_silence_duration_ms=vad_min_silence_ms),
+        )
+        parts = []
+        for seg in segments:
+            parts.append(seg.text)
+        return " ".join(parts).strip(), info
 
-    text = " ".join([seg.text for seg in segments]).strip()
+    try:
+        async with TRANSCRIBE_SEM:
+            text, info = await asyncio.get_running_loop().run_in_executor(EXECUTOR, _run_transcribe)
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": f"Transcription failed: {e}"})
     language = info.language if hasattr(info, "language") else None
     duration = info.duration if hasattr(info, "duration") else None
 
     # Save as DOCX
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    docx_name = f"{base_name}_{ts}.docx"
-    docx_path = os.path.join(OUTPUT_DIR, docx_name)
+    docx_name = f"{base_name}_{secrets.token_urlsafe(6)}.docx"
+    docx_path = f"{OUTPUT_DIR}/{docx_name}"
+    start_docx_build(docx_name, docx_path, file.filename, model_size, language, duration, text)
 
-    doc = Document()
-    doc.add_heading("Transcription", level=1)
-    meta = doc.add_paragraph()
-    meta.add_run("Source: ").bold = True
-    meta.add_run(file.filename or "Uploaded file")
-    meta.add_run("\nModel: ").bold = True
-    meta.add_run(model_size)
-    if language:
-        meta.add_run("\nDetected language: ").bold = True
-        meta.add_run(str(language))
-    if duration:
-        meta.add_run("\nDuration: ").bold = True
-        meta.add_run(f"{duration:.1f}s")
-    doc.add_paragraph("")
-    if text:
-        doc.add_paragraph(text)
-
-    doc.save(docx_path)
-
-    return {
+    result = {
         "ok": True,
         "text": text,
         "docx_file": f"/download/{docx_name}",
@@ -111,9 +335,139 @@ async def transcribe_api(
         "filename": file.filename,
     }
 
+    RESULT_CACHE[cache_key] = result
+    while len(RESULT_CACHE) > RESULT_CACHE_SIZE:
+        RESULT_CACHE.popitem(last=False)
+
+    return result
+
+@app.post("/api/transcribe/stream")
+async def transcribe_stream_api(
+    file: UploadFile,
+    model_size: str = Form(DEFAULT_MODEL),
+    beam_size: int = Form(DEFAULT_BEAM_SIZE),
+    word_timestamps: Optional[bool] = Form(False),
+    vad_filter: bool = Form(True),
+    vad_min_silence_ms: int = Form(500)
+):
+    base_name = os.path.splitext(file.filename or "audio")[0]
+
+    try:
+        audio = await asyncio.to_thread(decode_upload, file.file)
+    except Exception as e:
+        return JSONResponse(status_code=400, content={"error": f"Could not decode audio: {e}"})
+
+    model_size = model_size or DEFAULT_MODEL
+    try:
+        async with _model_locks[model_size]:
+            # a cache miss loads weights (seconds to minutes) — keep that
+            # off the event loop
+            await asyncio.to_thread(get_model, model_size)
+    except Exception as e:
+        return JSONResponse(status_code=400, content={"error": f"Failed to load model '{model_size}': {e}"})
+
+    # emit one NDJSON line per segment as the lazy generator is consumed, so
+    # the first line arrives after the first segment is decoded rather than
+    # after the whole file; a final line links the DOCX built from the
+    # accumulated text
+    async def gen():
+        async with TRANSCRIBE_SEM:
+            segments, info = await asyncio.get_running_loop().run_in_executor(
+                EXECUTOR,
+                lambda: run_transcribe(
+                    model_size, audio,
+                    beam_size=beam_size,
+                    word_timestamps=bool(word_timestamps),
+                    vad_filter=vad_filter,
+                    vad_parameters=dict(min_silence_duration_ms=vad_min_silence_ms),
+                ),
+            )
+            parts = []
+            async for seg in iterate_in_threadpool(segments):
+                parts.append(seg.text)
+                yield json.dumps({"start": seg.start, "end": seg.end, "text": seg.text}) + "\n"
+
+        text = " ".join(parts).strip()
+        language = info.language if hasattr(info, "language") else None
+        duration = info.duration if hasattr(info, "duration") else None
+
+        docx_name = f"{base_name}_{secrets.token_urlsafe(6)}.docx"
+        docx_path = f"{OUTPUT_DIR}/{docx_name}"
+        await asyncio.to_thread(build_docx, docx_path, file.filename, model_size, language, duration, text)
+
+        yield json.dumps({
+            "done": True,
+            "docx_file": f"/download/{docx_name}",
+            "model": model_size,
+            "language": language,
+            "duration_seconds": duration,
+            "filename": file.filename,
+        }) + "\n"
+
+    return StreamingResponse(gen(), media_type="application/x-ndjson")
+
+WS_SAMPLE_RATE = 16000
+WS_CHUNK_SECONDS = int(os.getenv("WS_CHUNK_SECONDS", "20"))
+_WS_CHUNK_BYTES = WS_CHUNK_SECONDS * WS_SAMPLE_RATE * 2  # PCM16 mono
+
+@app.websocket("/api/transcribe/ws")
+async def transcribe_ws(ws: WebSocket):
+    # expects raw little-endian PCM16 mono 16 kHz frames; every
+    # WS_CHUNK_SECONDS of buffered audio is decoded and emitted as one JSON
+    # message per segment, so latency is roughly one chunk instead of the
+    # whole recording
+    await ws.accept()
+    buf = bytearray()
+    prev = ""
+    try:
+        while True:
+            msg = await ws.receive()
+            if msg["type"] == "websocket.disconnect":
+                break
+            data = msg.get("bytes")
+            if data is None:  # ignore text frames from misbehaving clients
+                continue
+            buf += data
+            if len(buf) < _WS_CHUNK_BYTES:
+                continue
+            audio = np.frombuffer(bytes(buf), dtype=np.int16).astype(np.float32) / 32768.0
+            buf.clear()
+
+            # the previous chunk's text as prompt keeps context across the
+            # chunk boundary
+            def _decode(audio=audio, prompt=prev):
+                segments, _ = get_model(DEFAULT_MODEL).transcribe(
+                    audio,
+                    beam_size=1,
+                    condition_on_previous_text=True,
+                    initial_prompt=prompt or None,
+                )
+                return list(segments)
+
+            async with TRANSCRIBE_SEM:
+                segs = await asyncio.get_running_loop().run_in_executor(EXECUTOR, _decode)
+
+            for seg in segs:
+                await ws.send_json({"start": seg.start, "end": seg.end, "text": seg.text})
+            prev = " ".join(seg.text for seg in segs).strip()
+    except WebSocketDisconnect:
+        pass
+
 @app.get("/download/{fname}")
 async def download_file(fname: str):
+    # wait for an in-flight DOCX build before serving it
+    task = _docx_tasks.get(fname)
+    if task is not None:
+        try:
+            await task
+        except Exception as e:
+            return JSONResponse(status_code=500, content={"error": f"Failed to build DOCX: {e}"})
+
+    # one stat, off the event loop; FileResponse reuses it instead of
+    # stat-ing the file a second time
     path = os.path.join(OUTPUT_DIR, fname)
-    if not os.path.exists(path):
+    try:
+        st = await asyncio.to_thread(os.stat, path)
+    except FileNotFoundError:
         return JSONResponse(status_code=404, content={"error": "File not found"})
-    return FileResponse(path, filename=fname)
+    return FileResponse(path, filename=fname, stat_result=st)